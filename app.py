@@ -7,9 +7,19 @@ Created on Wed Oct  8 12:14:00 2025
 
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import datetime
+import os
+import tempfile
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from gspread.utils import DateTimeOption, ValueRenderOption, rowcol_to_a1
 from streamlit_gsheets import GSheetsConnection
+from streamlit_gsheets.gsheets_connection import GSheetsPublicSpreadsheetClient
 
 # --- CONFIGURATION ---
 st.set_page_config(
@@ -18,6 +28,28 @@ st.set_page_config(
     layout="wide"
 )
 
+COLUMNS = [
+    'Transaction', 'Amount', 'Type', 'Paid by', 'Date of Transaction',
+    'Entered by', 'Timestamp', 'Location'
+]
+CATEGORICAL_COLUMNS = ['Type', 'Paid by', 'Entered by']
+TEXT_COLUMNS = ['Transaction', 'Location']
+PAYERS = ['AK', 'AA']
+TRANSACTION_TYPES = [
+    'Shared Expense', 'For AK only', 'For AA only',
+    'Repayment from AK to AA', 'Repayment from AA to AK'
+]
+# Fixed category sets, so the codes don't depend on which values happen to be in the sheet
+KNOWN_CATEGORIES = {'Type': TRANSACTION_TYPES, 'Paid by': PAYERS}
+# Last parsed copy of the sheet, used to warm-start after a restart. It lives in a private
+# directory because it holds the whole ledger.
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aaset")
+SNAPSHOT_PATH = os.path.join(SNAPSHOT_DIR, "sheet_snapshot.parquet")
+# Bump whenever load_data's output (columns, dtypes, index) changes, so older snapshots are ignored
+SNAPSHOT_FORMAT = "1"
+# Prefix of the revision used when Drive can't report one; such revisions don't identify a version
+UNTRACKED_REVISION = "untracked-"
+
 # --- STYLING ---
 st.markdown("""
 <style>
@@ -70,6 +102,14 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- GOOGLE SHEETS CONNECTION ---
+@st.cache_resource
+def get_worksheet(_conn):
+    """Resolves Sheet1 once per process so writes don't re-fetch the spreadsheet metadata.
+
+    _select_worksheet is private to st-gsheets-connection, which is why requirements.txt pins it.
+    """
+    return _conn.client._select_worksheet(worksheet="Sheet1")
+
 try:
     conn = st.connection("gsheets", type=GSheetsConnection)
 except Exception as e:
@@ -78,47 +118,307 @@ except Exception as e:
     st.stop()
 
 
+@st.cache_resource
+def http_session():
+    """Shared HTTP session so repeated lookups reuse the kept-alive connection."""
+    session = requests.Session()
+    session.headers["Accept"] = "application/json"
+    return session
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_location():
     """Fetches the user's estimated location based on IP address."""
     try:
-        response = requests.get("https://ipinfo.io/json", timeout=5)
+        response = http_session().get("https://ipinfo.io/json", timeout=5)
         data = response.json()
         return f"{data.get('city', 'N/A')}, {data.get('country', 'N/A')}"
     except requests.RequestException:
         return "Location N/A"
 
-@st.cache_data(ttl=60)
-def load_data(_conn):
-    """Loads and cleans transaction data from the Google Sheet."""
+def parse_datetime_column(values):
+    """Parses a date/time column, using the fast ISO 8601 path for the format the app writes."""
+    parsed = pd.to_datetime(values, format='ISO8601', errors='coerce')
+    # Rows entered by hand in the sheet may use another format; only those fall back to inference
+    fallback = parsed.isna() & values.notna()
+    if fallback.any():
+        parsed[fallback] = pd.to_datetime(values[fallback], errors='coerce')
+    return parsed
+
+@st.cache_data(ttl=10, show_spinner=False)
+def sheet_revision(_conn):
+    """Returns a token that changes whenever the sheet is modified, used to key the load_data cache."""
+    if isinstance(_conn.client, GSheetsPublicSpreadsheetClient):
+        # Public-URL connections have no Drive access; fall back to refreshing once a minute
+        return f"{UNTRACKED_REVISION}{int(time.time() // 60)}"
+    # One small Drive metadata request instead of downloading the whole sheet
+    return get_worksheet(_conn).spreadsheet.get_lastUpdateTime()
+
+def snapshot_tag(_conn, revision):
+    """Identifies the exact sheet version a snapshot holds, or None if it can't be pinned down.
+
+    A snapshot is only ever served when it matches the live sheet's id and Drive revision, so it
+    is a copy of the current sheet rather than a second copy that could drift from it.
+    """
+    if revision.startswith(UNTRACKED_REVISION):
+        return None
     try:
-        df = _conn.read(usecols=list(range(8)), ttl=60) # Use TTL here for caching
-        df.dropna(how="all", inplace=True)
-        df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce').fillna(0)
-        df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
-        df['Date of Transaction'] = pd.to_datetime(df['Date of Transaction'], errors='coerce').dt.date
-        df = df.sort_values(by="Date of Transaction").reset_index(drop=True)
-        return df
-    except Exception as e:
-        st.error(f"Failed to load data from Google Sheets: {e}")
-        return pd.DataFrame(columns=[
-            'Transaction', 'Amount', 'Type', 'Paid by', 'Date of Transaction', 
-            'Entered by', 'Timestamp', 'Location'
-        ])
-
-def save_data(_conn, df):
-    """Saves the DataFrame to the Google Sheet using the correct .update() method."""
+        spreadsheet_id = get_worksheet(_conn).spreadsheet.id
+    except Exception:
+        return None
+    return {b"format": SNAPSHOT_FORMAT.encode(), b"spreadsheet": str(spreadsheet_id).encode(),
+            b"revision": revision.encode()}
+
+def read_snapshot(tag):
+    """Returns the on-disk copy of the sheet if it was saved for this tag, otherwise None."""
+    if tag is None:
+        return None
+    try:
+        table = pq.read_table(SNAPSHOT_PATH)
+    except (OSError, pa.ArrowException):
+        return None
+    metadata = table.schema.metadata or {}
+    if any(metadata.get(key) != value for key, value in tag.items()):
+        return None
+    return table.to_pandas()
+
+def write_snapshot(df, tag):
+    """Saves the parsed sheet to disk so a restarted server can skip the download."""
+    if tag is None:
+        return
+    tmp_path = None
+    try:
+        table = pa.Table.from_pandas(df)
+        table = table.replace_schema_metadata({**table.schema.metadata, **tag})
+        os.makedirs(SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+        os.chmod(SNAPSHOT_DIR, 0o700)
+        # mkstemp creates a fresh owner-only file, so concurrent writers never share a temp file
+        fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".parquet.tmp")
+        with os.fdopen(fd, "wb") as f:
+            pq.write_table(table, f)
+        os.replace(tmp_path, SNAPSHOT_PATH) # Readers never see a half-written file
+    except (OSError, pa.ArrowException):
+        # The snapshot is only a warm-start optimization
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def empty_transactions():
+    """Returns an empty frame with the same columns and dtypes load_data produces."""
+    return pd.DataFrame(columns=COLUMNS).astype({
+        'Amount': 'float64', 'Date of Transaction': 'datetime64[ns]', 'Timestamp': 'datetime64[ns]',
+        **{col: pd.CategoricalDtype(KNOWN_CATEGORIES.get(col, [])) for col in CATEGORICAL_COLUMNS},
+        **{col: 'string[pyarrow]' for col in TEXT_COLUMNS},
+    })
+
+# Only the latest revision is read again, so keep just that and the one before it
+@st.cache_data(ttl=24 * 60 * 60, max_entries=2, show_spinner=False)
+def load_data(_conn, revision):
+    """Loads and cleans transaction data from the Google Sheet.
+
+    Cached per sheet revision, so the sheet is only downloaded again after it changes. After a
+    server restart, an unchanged sheet is read back from the Parquet snapshot instead.
+    Errors are raised rather than returned so a failed load isn't cached for the revision.
+    """
+    tag = snapshot_tag(_conn, revision)
+    snapshot = read_snapshot(tag)
+    if snapshot is not None:
+        return snapshot
+
+    df = _conn.read(usecols=list(range(8)), ttl=0) # Caching is done here, keyed on the revision
+    df.dropna(how="all", inplace=True)
+    df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce').fillna(0)
+    # Free-text columns as Arrow strings: one contiguous buffer instead of a Python object per cell
+    df[TEXT_COLUMNS] = df[TEXT_COLUMNS].astype('string[pyarrow]')
+    df['Timestamp'] = parse_datetime_column(df['Timestamp'])
+    # Kept as datetime64 (midnight) so the sorted column can be binary-searched
+    df['Date of Transaction'] = parse_datetime_column(df['Date of Transaction']).dt.normalize()
+    # Low-cardinality columns as categoricals so masks and groupbys work on integer codes
+    for col in CATEGORICAL_COLUMNS:
+        known = KNOWN_CATEGORIES.get(col, [])
+        # Keep any unexpected values from manual sheet edits instead of turning them into NaN
+        extra = pd.Index(df[col].dropna().unique()).difference(known)
+        df[col] = pd.Categorical(df[col], categories=[*known, *extra])
+    # Index rows by their sheet row number (row 1 is the header) so edits can be written in place
+    df.index = df.index + 2
+    # Rows are usually already in date order, so only sort when they aren't. A stable sort keeps
+    # same-day rows in entry order, matching what an already-sorted sheet would give.
+    if not df['Date of Transaction'].is_monotonic_increasing:
+        df = df.sort_values(by="Date of Transaction", kind="stable")
+    write_snapshot(df, tag)
+    return df
+
+def invalidate_sheet_cache():
+    """Drops only the cached sheet data after a write, leaving other cached results warm."""
+    sheet_revision.clear()
+    load_data.clear()
+    try:
+        # Drive's update time can lag a write, so don't let the old snapshot pass for the new sheet
+        os.remove(SNAPSHOT_PATH)
+    except OSError:
+        pass
+
+def format_datetime_column(values, fmt):
+    """Formats a date/time column as strings with Arrow's vectorized strftime kernel."""
+    arr = pa.array(pd.to_datetime(values))
+    # Truncate to whole seconds, otherwise Arrow's %S also prints the fraction
+    arr = arr.cast(pa.timestamp('s', tz=arr.type.tz), safe=False)
+    return pc.strftime(arr, format=fmt).to_numpy(zero_copy_only=False)
+
+def sheet_values(df):
+    """Formats rows of the transactions frame as the plain cell values written to the sheet."""
+    df_copy = df[COLUMNS].copy()
+    df_copy['Date of Transaction'] = format_datetime_column(df_copy['Date of Transaction'], '%Y-%m-%d')
+    df_copy['Timestamp'] = format_datetime_column(df_copy['Timestamp'], '%Y-%m-%d %H:%M:%S')
+    return df_copy.astype(object).where(df_copy.notna(), "").values.tolist()
+
+def sheet_frame(df):
+    """Returns a copy of df with its date/time columns as the strings written to the sheet."""
+    df_copy = df.copy()
+    df_copy['Date of Transaction'] = format_datetime_column(df_copy['Date of Transaction'], '%Y-%m-%d')
+    df_copy['Timestamp'] = format_datetime_column(df_copy['Timestamp'], '%Y-%m-%d %H:%M:%S')
+    return df_copy
+
+def frame_fingerprint(df):
+    """Hashes the values of df, ignoring its index."""
+    return int(pd.util.hash_pandas_object(df, index=False).sum())
+
+def save_data(_conn, df, loaded_df):
+    """Saves the DataFrame to the Google Sheet using the correct .update() method.
+
+    loaded_df is the frame df was edited from. Returns True if the sheet now holds df.
+    """
     try:
         # Convert date/time columns to strings for compatibility
-        df_copy = df.copy()
-        df_copy['Date of Transaction'] = pd.to_datetime(df_copy['Date of Transaction']).dt.strftime('%Y-%m-%d')
-        df_copy['Timestamp'] = pd.to_datetime(df_copy['Timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
-        
+        df_copy = sheet_frame(df)
+
+        # Skip the round-trip if the edits cancelled out. This compares with what was loaded from
+        # the sheet, not with this session's last write, which someone else may have since changed.
+        if frame_fingerprint(df_copy) == frame_fingerprint(sheet_frame(loaded_df)):
+            return True
+
         # The .update() method is the correct way to write data with this library.
         # It clears the sheet and writes the new dataframe in one operation.
         _conn.update(worksheet="Sheet1", data=df_copy)
-        st.cache_data.clear() # Clear cache after writing
+        invalidate_sheet_cache()
+        return True
     except Exception as e:
         st.error(f"Failed to save data to Google Sheets: {e}")
+        return False
+
+def append_transaction(_conn, row):
+    """Appends a single transaction to the Google Sheet without rewriting the existing rows."""
+    try:
+        values = dict(row)
+        values['Date of Transaction'] = values['Date of Transaction'].strftime('%Y-%m-%d')
+        values['Timestamp'] = values['Timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+
+        # The connection has no append method, so go through its gspread worksheet.
+        worksheet = get_worksheet(_conn)
+        worksheet.append_row([values[col] for col in COLUMNS], value_input_option="USER_ENTERED")
+        invalidate_sheet_cache()
+    except Exception as e:
+        st.error(f"Failed to add transaction to Google Sheets: {e}")
+
+def row_identity(df):
+    """Description, amount and entry time of each row, parsed the way load_data parses them."""
+    timestamps = parse_datetime_column(df['Timestamp']).astype(object)
+    return list(zip(
+        # As text, since an unformatted read returns a numeric-looking description as a number
+        df['Transaction'].astype('string[pyarrow]').astype(object).where(df['Transaction'].notna(), None),
+        pd.to_numeric(df['Amount'], errors='coerce').fillna(0),
+        timestamps.where(timestamps.notna(), None),
+    ))
+
+def rows_still_match(worksheet, df, rows, check_end=False):
+    """Re-reads the given sheet rows and checks they still hold the transactions loaded into df.
+
+    Row numbers come from a cached load, so an insert or delete by the other user since then
+    would shift them and a write would land on the wrong transaction. With check_end, the row
+    after the last loaded one must also still be empty, i.e. nothing was appended since.
+    """
+    rows = [int(row) for row in rows]
+    end = int(df.index.max()) + 1 if len(df) else 2
+    wanted = rows + [end] if check_end else rows
+    if not wanted:
+        return True
+    # One contiguous range rather than a range per row, which would overflow the GET URL on
+    # large sheets. Values are rendered the way load_data reads them, so cell formats don't matter.
+    first, last = min(wanted), max(wanted)
+    fetched = worksheet.get(
+        f"{rowcol_to_a1(first, 1)}:{rowcol_to_a1(last, len(COLUMNS))}",
+        value_render_option=ValueRenderOption.unformatted,
+        date_time_render_option=DateTimeOption.formatted_string,
+    )
+    # Trailing empty rows are left out of the response
+    values = [(list(row) + [""] * len(COLUMNS))[:len(COLUMNS)] for row in fetched]
+    values += [[""] * len(COLUMNS)] * (last - first + 1 - len(values))
+    if check_end and any(cell != "" for cell in values[end - first]):
+        return False
+    current = pd.DataFrame([values[row - first] for row in rows], columns=COLUMNS).replace("", np.nan)
+    return row_identity(current) == row_identity(df.loc[rows])
+
+def save_changes(_conn, df, edited_df, changes):
+    """Writes only the rows changed in the data editor, falling back to a full save for large edits.
+
+    df is indexed by sheet row number; the editor works on a RangeIndex copy of it, so its
+    positional changes map to sheet rows through df.index. Returns True if the changes were saved.
+    """
+    sheet_rows = df.index.to_numpy()
+    deleted = sorted(changes["deleted_rows"])
+    # Edits that only rename the row label (_index) have nothing to write to the sheet
+    edited = sorted(
+        position for position, cols in changes["edited_rows"].items()
+        if position not in deleted and any(col in COLUMNS for col in cols)
+    )
+    # The editor applies edits, then deletions, then additions, so the surviving original rows come
+    # first in edited_df in their original order and anything after them is a row it actually added.
+    # Map by position rather than label, since labels can be renamed or reused after a deletion.
+    surviving = len(df) - len(deleted)
+    edited_rows = edited_df.iloc[[position - np.searchsorted(deleted, position) for position in edited]]
+    added = edited_df.iloc[surviving:]
+    full_save = len(edited) + len(deleted) + len(added) > len(df) / 2
+
+    try:
+        worksheet = get_worksheet(_conn)
+        if full_save:
+            matches = rows_still_match(worksheet, df, sheet_rows, check_end=True)
+        else:
+            matches = rows_still_match(worksheet, df, sheet_rows[sorted(set(edited) | set(deleted))])
+        if not matches:
+            invalidate_sheet_cache()
+            st.error("The sheet was changed by someone else since it was loaded, so nothing was saved. "
+                     "The table now shows the latest data; please make your changes again.")
+            return False
+        if full_save:
+            return save_data(_conn, edited_df, df)
+
+        # Only the cells the user touched, so other columns of the row are never overwritten
+        cell_updates = [
+            {'range': rowcol_to_a1(int(row), COLUMNS.index(col) + 1), 'values': [[values[COLUMNS.index(col)]]]}
+            for position, row, values in zip(edited, sheet_rows[edited], sheet_values(edited_rows))
+            for col in changes["edited_rows"][position] if col in COLUMNS
+        ]
+        # Edits to anything but the sheet columns (e.g. the index) leave nothing to send
+        if cell_updates:
+            worksheet.batch_update(cell_updates, value_input_option="USER_ENTERED")
+        if len(added):
+            worksheet.append_rows(sheet_values(added), value_input_option="USER_ENTERED")
+        if deleted:
+            # One batchUpdate applies atomically; bottom-up keeps each remaining row number valid
+            worksheet.spreadsheet.batch_update({"requests": [
+                {"deleteDimension": {"range": {
+                    "sheetId": worksheet.id, "dimension": "ROWS",
+                    "startIndex": int(row) - 1, "endIndex": int(row),
+                }}}
+                for row in sorted(sheet_rows[deleted], reverse=True)
+            ]})
+        invalidate_sheet_cache()
+        return True
+    except Exception as e:
+        st.error(f"Failed to save changes to Google Sheets: {e}")
+        return False
 
 # --- AUTHENTICATION ---
 def check_password():
@@ -161,12 +461,33 @@ def check_password():
 if not check_password():
     st.stop()
 
+@st.cache_resource
+def background_executor():
+    """Shared worker thread for lookups that shouldn't block a script run."""
+    return ThreadPoolExecutor(max_workers=1)
+
+def current_location():
+    """Returns the session's location, or a placeholder if the lookup hasn't finished yet."""
+    try:
+        return st.session_state["location"].result(timeout=0.1)
+    except FutureTimeoutError:
+        return "Location N/A"
+
+# Look the location up once per session, in the background, so neither the first page load
+# nor adding a transaction waits on ipinfo.io
+if "location" not in st.session_state:
+    st.session_state["location"] = background_executor().submit(get_location)
+
 st.sidebar.write(f"Welcome, **{st.session_state['user']}**!")
 if st.sidebar.button("Logout"):
     st.session_state["user_logged_in"] = False
     st.rerun()
 
-transactions_df = load_data(conn)
+try:
+    transactions_df = load_data(conn, sheet_revision(conn))
+except Exception as e:
+    st.error(f"Failed to load data from Google Sheets: {e}")
+    transactions_df = empty_transactions()
 
 # --- BALANCE CALCULATION (CLEANED UP) ---
 def calculate_balance_and_summary(df):
@@ -176,25 +497,34 @@ def calculate_balance_and_summary(df):
             'total_paid_by_AK': 0, 'total_paid_by_AA': 0, 'shared_expenses': 0,
             'shared_paid_by_ak': 0, 'shared_paid_by_aa': 0, 'ak_only_paid_by_aa': 0,
             'aa_only_paid_by_ak': 0, 'repayment_ak_to_aa': 0, 'repayment_aa_to_ak': 0,
+            'total_paid_by': {}, 'ak_share': 0.0, 'ak_overpayment': 0.0,
         }
         
+    # One pass over the data; every figure below is a cell (or margin) of this table.
+    totals = df.groupby(['Type', 'Paid by'], sort=False, observed=True, dropna=False)['Amount'].sum()
+    type_totals = totals.groupby(level='Type', observed=True, dropna=False).sum()
+    paid_by_totals = totals.groupby(level='Paid by', observed=True, dropna=False).sum()
+
     summary = {
-        'total_paid_by_AK': df[df['Paid by'] == 'AK']['Amount'].sum(),
-        'total_paid_by_AA': df[df['Paid by'] == 'AA']['Amount'].sum(),
-        'shared_expenses': df[df['Type'] == 'Shared Expense']['Amount'].sum(),
-        'shared_paid_by_ak': df[(df['Type'] == 'Shared Expense') & (df['Paid by'] == 'AK')]['Amount'].sum(),
-        'shared_paid_by_aa': df[(df['Type'] == 'Shared Expense') & (df['Paid by'] == 'AA')]['Amount'].sum(),
-        'ak_only_paid_by_aa': df[(df['Type'] == 'For AK only') & (df['Paid by'] == 'AA')]['Amount'].sum(),
-        'aa_only_paid_by_ak': df[(df['Type'] == 'For AA only') & (df['Paid by'] == 'AK')]['Amount'].sum(),
-        'repayment_ak_to_aa': df[df['Type'] == 'Repayment from AK to AA']['Amount'].sum(),
-        'repayment_aa_to_ak': df[df['Type'] == 'Repayment from AA to AK']['Amount'].sum(),
+        'total_paid_by_AK': paid_by_totals.get('AK', 0.0),
+        'total_paid_by_AA': paid_by_totals.get('AA', 0.0),
+        'shared_expenses': type_totals.get('Shared Expense', 0.0),
+        'shared_paid_by_ak': totals.get(('Shared Expense', 'AK'), 0.0),
+        'shared_paid_by_aa': totals.get(('Shared Expense', 'AA'), 0.0),
+        'ak_only_paid_by_aa': totals.get(('For AK only', 'AA'), 0.0),
+        'aa_only_paid_by_ak': totals.get(('For AA only', 'AK'), 0.0),
+        'repayment_ak_to_aa': type_totals.get('Repayment from AK to AA', 0.0),
+        'repayment_aa_to_ak': type_totals.get('Repayment from AA to AK', 0.0),
+        'total_paid_by': paid_by_totals.to_dict(), # Every payer, not just AK and AA
     }
     
     # Balance from AK's perspective: Positive means AA owes AK.
-    ak_share = summary['shared_expenses'] / 2.0 if summary['shared_expenses'] > 0 else 0.0
+    # The breakdown expander shows these two figures, so they're returned with the summary.
+    summary['ak_share'] = summary['shared_expenses'] / 2.0 if summary['shared_expenses'] > 0 else 0.0
+    summary['ak_overpayment'] = summary['shared_paid_by_ak'] - summary['ak_share']
     
     # Start with what AK is owed (or owes) from shared costs
-    balance = summary['shared_paid_by_ak'] - ak_share
+    balance = summary['ak_overpayment']
     
     # Add what AK is owed for paying for AA's things
     balance += summary['aa_only_paid_by_ak']
@@ -210,22 +540,70 @@ def calculate_balance_and_summary(df):
 
     return balance, summary
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def build_transaction_log(df):
+    """Builds the transaction-by-transaction balance log as a single Markdown string.
+
+    Cached on the frame's contents, so the log is only re-formatted after the data changes.
+    """
+    amount = df['Amount'].to_numpy(dtype=float)
+    share = amount / 2.0
+    paid_by_ak = (df['Paid by'] == 'AK').to_numpy()
+    is_shared = (df['Type'] == 'Shared Expense').to_numpy()
+
+    # Balance change per row from AK's perspective, same rules as calculate_balance_and_summary
+    conditions = [
+        is_shared & paid_by_ak,
+        is_shared & ~paid_by_ak,
+        (df['Type'] == 'For AA only').to_numpy() & paid_by_ak,
+        (df['Type'] == 'For AK only').to_numpy() & (df['Paid by'] == 'AA').to_numpy(),
+        (df['Type'] == 'Repayment from AA to AK').to_numpy(),
+        (df['Type'] == 'Repayment from AK to AA').to_numpy(),
+    ]
+    logic_templates = [
+        "Shared cost paid by AK. Balance increases (AA owes more): `+₹{:,.2f}`.",
+        "Shared cost paid by AA. Balance decreases (AK owes more): `-₹{:,.2f}`.",
+        "AK paid for AA. Balance increases: `+₹{:,.2f}`.",
+        "AA paid for AK. Balance decreases: `-₹{:,.2f}`.",
+        "AA repaid AK. AA's debt reduces. Balance decreases: `-₹{:,.2f}`.",
+        "AK repaid AA. AK's debt reduces. Balance increases: `+₹{:,.2f}`.",
+        "",
+    ]
+    case = np.select(conditions, range(len(conditions)), default=len(conditions))
+    magnitude = np.select(conditions, [share, share, amount, amount, amount, amount], default=0.0)
+    balance_change = np.select(conditions, [share, -share, amount, -amount, -amount, amount], default=0.0)
+    running_balance = np.cumsum(balance_change)
+    previous_balance = np.concatenate(([0.0], running_balance[:-1]))
+
+    lines = ["**Initial Balance:** `₹0.00`", "---"]
+    for number, description, amt, c, mag, change, prev, new in zip(
+        range(1, len(df) + 1), df['Transaction'], amount, case, magnitude,
+        balance_change, previous_balance, running_balance
+    ):
+        lines += [
+            f"**Transaction {number}:** *{description}* (`₹{amt:,.2f}`)",
+            f"> *{logic_templates[c].format(mag)}*",
+            f"> **New Balance:** `{prev:,.2f} + ({change:,.2f}) =` **`₹{new:,.2f}`**",
+            "---",
+        ]
+    return "\n\n".join(lines)
+
 # --- UI DISPLAY ---
 st.title("💸 AK & AA Shared Expense Tracker")
 st.markdown("A persistent expense tracker powered by Google Sheets.")
 st.markdown("---")
 
+balance, summary_data = calculate_balance_and_summary(transactions_df)
+
 col1, col2, col3 = st.columns(3)
-total_shared = transactions_df['Amount'][transactions_df['Type'] == 'Shared Expense'].sum()
-total_paid_by_user = transactions_df['Amount'][transactions_df['Paid by'] == st.session_state['user']].sum()
+total_shared = summary_data['shared_expenses']
+total_paid_by_user = summary_data['total_paid_by'].get(st.session_state['user'], 0.0)
 col1.metric("Total Shared Spending", f"₹{total_shared:,.2f}")
 col2.metric(f"Total Paid by You ({st.session_state['user']})", f"₹{total_paid_by_user:,.2f}")
 col3.metric("Total Transactions", f"{len(transactions_df)}")
 
 st.markdown("---")
 
-balance, summary_data = calculate_balance_and_summary(transactions_df)
-
 _, center_col, _ = st.columns([1, 2, 1])
 with center_col:
     if balance > 0.01:
@@ -241,28 +619,27 @@ with center_col:
 with st.expander("Show Calculation Breakdown"):
     st.subheader("High-Level Summary (from AK's perspective)")
     
-    ak_share = summary_data['shared_expenses'] / 2.0 if summary_data['shared_expenses'] > 0 else 0.0
-    ak_overpayment = summary_data['shared_paid_by_ak'] - ak_share
+    ak_share = summary_data['ak_share']
+    ak_overpayment = summary_data['ak_overpayment']
     
-    st.markdown("##### 1. Shared Costs Analysis")
-    st.markdown(f"- **Total Shared Expenses:** `₹{summary_data['shared_expenses']:,.2f}`\n"
+    # Each section's heading and body go out in one markdown element
+    st.markdown("##### 1. Shared Costs Analysis\n\n"
+                f"- **Total Shared Expenses:** `₹{summary_data['shared_expenses']:,.2f}`\n"
                 f"- **Each Person's Share (50%):** `₹{ak_share:,.2f}`\n"
                 f"- **Amount AK Paid for Shared Costs:** `₹{summary_data['shared_paid_by_ak']:,.2f}`")
     if ak_overpayment > 0:
         st.success(f"Logic: AK paid `₹{ak_overpayment:,.2f}` more than their share. This is a credit for AK.")
     else:
         st.warning(f"Logic: AK paid `₹{-ak_overpayment:,.2f}` less than their share. This is a debit for AK.")
-    st.markdown("---")
 
-    st.markdown("##### 2. Individual Costs & Repayments")
-    st.markdown(f"- **Costs for AA Only (Paid by AK):** `₹{summary_data['aa_only_paid_by_ak']:,.2f}` (Credit for AK)\n"
+    st.markdown("---\n\n##### 2. Individual Costs & Repayments\n\n"
+                f"- **Costs for AA Only (Paid by AK):** `₹{summary_data['aa_only_paid_by_ak']:,.2f}` (Credit for AK)\n"
                 f"- **Costs for AK Only (Paid by AA):** `₹{summary_data['ak_only_paid_by_aa']:,.2f}` (Debit for AK)\n"
                 f"- **Repayments from AA to AK:** `₹{summary_data['repayment_aa_to_ak']:,.2f}` (Reduces AA's debt to AK)\n"
                 f"- **Repayments from AK to AA:** `₹{summary_data['repayment_ak_to_aa']:,.2f}` (Reduces AK's debt to AA)")
-    st.markdown("---")
 
-    st.markdown("##### 3. Final Calculation")
-    st.markdown(f"**Net from Shared Costs:** `₹{ak_overpayment:,.2f}`\n"
+    st.markdown("---\n\n##### 3. Final Calculation\n\n"
+                f"**Net from Shared Costs:** `₹{ak_overpayment:,.2f}`\n"
                 f"**+ Costs AK paid for AA:** `+ ₹{summary_data['aa_only_paid_by_ak']:,.2f}`\n"
                 f"**- Costs AA paid for AK:** `- ₹{summary_data['ak_only_paid_by_aa']:,.2f}`\n"
                 f"**+ Repayments from AK:** `+ ₹{summary_data['repayment_ak_to_aa']:,.2f}`\n"
@@ -271,42 +648,9 @@ with st.expander("Show Calculation Breakdown"):
     st.info("A positive final balance means AA owes AK. A negative balance means AK owes AA.")
 
     with st.expander("Show Detailed Transaction-by-Transaction Log"):
-        running_balance = 0.0
-        st.markdown(f"**Initial Balance:** `₹{running_balance:,.2f}`")
-        st.markdown("---")
-        
-        for index, row in transactions_df.iterrows():
-            st.markdown(f"**Transaction {index + 1}:** *{row['Transaction']}* (`₹{row['Amount']:,.2f}`)")
-            
-            logic_text = ""
-            balance_change = 0.0
-
-            if row['Type'] == 'Shared Expense':
-                share = row['Amount'] / 2.0
-                if row['Paid by'] == 'AK':
-                    balance_change = share
-                    logic_text = f"Shared cost paid by AK. Balance increases (AA owes more): `+₹{share:,.2f}`."
-                else: # Paid by AA
-                    balance_change = -share
-                    logic_text = f"Shared cost paid by AA. Balance decreases (AK owes more): `-₹{share:,.2f}`."
-            elif row['Type'] == 'For AA only' and row['Paid by'] == 'AK':
-                balance_change = row['Amount']
-                logic_text = f"AK paid for AA. Balance increases: `+₹{row['Amount']:,.2f}`."
-            elif row['Type'] == 'For AK only' and row['Paid by'] == 'AA':
-                balance_change = -row['Amount']
-                logic_text = f"AA paid for AK. Balance decreases: `-₹{row['Amount']:,.2f}`."
-            elif row['Type'] == 'Repayment from AA to AK':
-                balance_change = -row['Amount']
-                logic_text = f"AA repaid AK. AA's debt reduces. Balance decreases: `-₹{row['Amount']:,.2f}`."
-            elif row['Type'] == 'Repayment from AK to AA':
-                balance_change = row['Amount']
-                logic_text = f"AK repaid AA. AK's debt reduces. Balance increases: `+₹{row['Amount']:,.2f}`."
-            
-            st.markdown(f"> *{logic_text}*")
-            new_running_balance = running_balance + balance_change
-            st.markdown(f"> **New Balance:** `{running_balance:,.2f} + ({balance_change:,.2f}) =` **`₹{new_running_balance:,.2f}`**")
-            running_balance = new_running_balance
-            st.markdown("---")
+        # Expander bodies run even when collapsed, so only build the log on request
+        if st.checkbox("Render detailed log", value=False):
+            st.markdown(build_transaction_log(transactions_df))
 
 
 with st.sidebar:
@@ -315,91 +659,122 @@ with st.sidebar:
         transaction = st.text_input("Transaction Description", placeholder="e.g., Groceries")
         amount = st.number_input("Amount (₹)", min_value=0.01, format="%.2f")
         transaction_date = st.date_input("Date of Transaction", datetime.date.today())
-        paid_by = st.selectbox("Paid by", ["AK", "AA"], index=0)
-        trans_type = st.selectbox("Type", ['Shared Expense', 'For AK only', 'For AA only', 'Repayment from AK to AA', 'Repayment from AA to AK'], index=0)
+        paid_by = st.selectbox("Paid by", PAYERS, index=0)
+        trans_type = st.selectbox("Type", TRANSACTION_TYPES, index=0)
         
         if st.form_submit_button("Add Transaction"):
             if not transaction or amount <= 0:
                 st.warning("Please fill in all fields with a valid amount.")
             else:
-                new_entry = pd.DataFrame([{
+                append_transaction(conn, {
                     "Transaction": transaction, "Amount": amount, "Type": trans_type,
                     "Paid by": paid_by, "Date of Transaction": transaction_date,
                     "Entered by": st.session_state["user"], "Timestamp": datetime.datetime.now(datetime.timezone.utc),
-                    "Location": get_location()
-                }])
-                
-                updated_df = pd.concat([transactions_df, new_entry], ignore_index=True)
-                save_data(conn, updated_df)
+                    "Location": current_location()
+                })
                 st.success("Transaction added!")
                 st.rerun()
 
-st.markdown("---")
-st.header("Transaction History")
-
-filtered_df = transactions_df.copy()
-st.subheader("Filter Transactions")
-filter_cols = st.columns([1, 1, 2])
+# --- TRANSACTION HISTORY ---
+@st.fragment
+def transaction_history():
+    """Renders the filterable history and the editor; filter changes only rerun this block."""
+    st.markdown("---")
+    st.header("Transaction History")
 
-with filter_cols[0]:
-    paid_by_filter = st.multiselect(
-        "Paid by",
-        options=transactions_df["Paid by"].unique(),
-        default=transactions_df["Paid by"].unique()
-    )
+    st.subheader("Filter Transactions")
+    filter_cols = st.columns([1, 1, 2])
 
-with filter_cols[1]:
-    type_filter = st.multiselect(
-        "Type",
-        options=transactions_df["Type"].unique(),
-        default=transactions_df["Type"].unique()
-    )
+    # Categorical columns already know their distinct values, no need to scan for unique()
+    paid_by_options = transactions_df["Paid by"].cat.categories.tolist()
+    type_options = transactions_df["Type"].cat.categories.tolist()
 
-with filter_cols[2]:
-    if not transactions_df.empty and pd.api.types.is_datetime64_any_dtype(transactions_df["Date of Transaction"]):
-        min_date = transactions_df["Date of Transaction"].min()
-        max_date = transactions_df["Date of Transaction"].max()
-        if min_date > max_date: # Handle case where there's only one date
-             min_date = max_date
-        date_range = st.date_input(
-            "Select date range",
-            value=(min_date, max_date),
-            min_value=min_date,
-            max_value=max_date
+    with filter_cols[0]:
+        paid_by_filter = st.multiselect(
+            "Paid by",
+            options=paid_by_options,
+            default=paid_by_options
         )
-    else:
-        date_range = st.date_input("Select date range", value=(datetime.date.today(), datetime.date.today()))
 
+    with filter_cols[1]:
+        type_filter = st.multiselect(
+            "Type",
+            options=type_options,
+            default=type_options
+        )
 
-if paid_by_filter:
-    filtered_df = filtered_df[filtered_df["Paid by"].isin(paid_by_filter)]
-if type_filter:
-    filtered_df = filtered_df[filtered_df["Type"].isin(type_filter)]
-if len(date_range) == 2:
-    filtered_df = filtered_df[
-        (filtered_df["Date of Transaction"] >= date_range[0]) &
-        (filtered_df["Date of Transaction"] <= date_range[1])
-    ]
-
-st.dataframe(filtered_df, use_container_width=True)
+    with filter_cols[2]:
+        transaction_dates = transactions_df["Date of Transaction"]
+        last_dated = transaction_dates.last_valid_index()
+        if not transactions_df.empty and pd.api.types.is_datetime64_any_dtype(transaction_dates) \
+                and last_dated is not None:
+            # load_data sorts by date with undated rows last, so the bounds are the ends of the column
+            min_date = transaction_dates.iloc[0].date()
+            max_date = transaction_dates.loc[last_dated].date()
+            if min_date > max_date: # Handle case where there's only one date
+                 min_date = max_date
+            date_range = st.date_input(
+                "Select date range",
+                value=(min_date, max_date),
+                min_value=min_date,
+                max_value=max_date
+            )
+        else:
+            date_range = st.date_input("Select date range", value=(datetime.date.today(), datetime.date.today()))
+
+
+    # Combine every active filter into one mask and index the frame once; a selection that
+    # covers every option filters nothing, so it doesn't need an isin pass
+    mask = np.ones(len(transactions_df), dtype=bool)
+    if paid_by_filter and len(paid_by_filter) < len(paid_by_options):
+        mask &= transactions_df["Paid by"].isin(paid_by_filter).to_numpy()
+    if type_filter and len(type_filter) < len(type_options):
+        mask &= transactions_df["Type"].isin(type_filter).to_numpy()
+    if len(date_range) == 2:
+        # load_data sorts by date (undated rows last), so the range is one contiguous slice
+        transaction_dates = transactions_df["Date of Transaction"].to_numpy()
+        lo = np.searchsorted(transaction_dates, np.datetime64(date_range[0], 'D'), side='left')
+        hi = np.searchsorted(transaction_dates, np.datetime64(date_range[1], 'D'), side='right')
+        mask[:lo] = False
+        mask[hi:] = False
+    filtered_df = transactions_df.loc[mask]
+
+    st.dataframe(
+        filtered_df,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Date of Transaction": st.column_config.DateColumn("Date of Transaction", format="D MMM YYYY"),
+        }
+    )
 
-st.markdown("---")
-st.header("Edit Full Transaction History")
-st.info("You can edit, add, or delete entries directly in the table below. This table shows ALL transactions and is not affected by the filters above. Changes are saved automatically.")
-
-edited_df = st.data_editor(
-    transactions_df,
-    num_rows="dynamic",
-    use_container_width=True,
-    column_config={
-        "Amount": st.column_config.NumberColumn("Amount (₹)", format="₹%.2f"),
-        "Date of Transaction": st.column_config.DateColumn("Transaction Date", format="D MMM YYYY"),
-        "Timestamp": st.column_config.DatetimeColumn("Entry Timestamp", format="D MMM YYYY, h:mm a"),
-    },
-    key="data_editor"
-)
+    st.markdown("---")
+    st.header("Edit Full Transaction History")
+    st.info("You can edit, add, or delete entries directly in the table below. This table shows ALL transactions and is not affected by the filters above. Changes are saved automatically.")
+
+    # The editor only hides and auto-numbers a RangeIndex, so give it one; the sheet row numbers
+    # stay on transactions_df.index for save_changes
+    edited_df = st.data_editor(
+        transactions_df.reset_index(drop=True),
+        num_rows="dynamic",
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Amount": st.column_config.NumberColumn("Amount (₹)", format="₹%.2f"),
+            "Date of Transaction": st.column_config.DateColumn("Transaction Date", format="D MMM YYYY"),
+            "Timestamp": st.column_config.DatetimeColumn("Entry Timestamp", format="D MMM YYYY, h:mm a"),
+        },
+        key="data_editor"
+    )
 
-if not transactions_df.equals(edited_df):
-    save_data(conn, edited_df)
-    st.toast("Changes saved!", icon="✅")
-    st.rerun()
+    # The editor reports its own deltas, so there is no need to compare whole frames
+    changes = st.session_state["data_editor"]
+    if changes["edited_rows"] or changes["added_rows"] or changes["deleted_rows"]:
+        saved = save_changes(conn, transactions_df, edited_df, changes)
+        # Saved edits are part of the reloaded data; failed ones are dropped with the error shown
+        del st.session_state["data_editor"]
+        if saved:
+            st.toast("Changes saved!", icon="✅")
+            st.rerun()
+
+transaction_history()